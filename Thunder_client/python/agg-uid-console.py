@@ -1,72 +1,50 @@
 #!/usr/bin/env python3
 
-import requests
-from requests.auth import HTTPBasicAuth
-from collections import defaultdict
+import asyncio
+import httpx
 import sys
+import datetime
 
-def read_properties(file_path):
-    properties = {}
-    with open(file_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#'):
-                key, value = line.split('=', 1)
-                properties[key.strip()] = value.strip()
-    return properties['QW_USER'], properties['QW_PASS']
+from qw_common import read_properties, basic_auth_header, create_session, build_query, fetch_counts, pop_int_option
 
-def get_quickwit_results(query, auth):
-    url = "https://quickwit.a.uni.net.th/api/v1/nro-logs/search"
-    
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-    
-    response = requests.post(url, json=query, auth=auth, headers=headers)
-    response.raise_for_status()
-    return response.json()
+START_TIME = "2024-10-01T00:00:00Z"
+END_TIME = "2024-10-31T23:59:59Z"
+END_TIMESTAMP = datetime.datetime.strptime(END_TIME, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc).timestamp()
 
-def process_results(aggregations):
-    user_counts = defaultdict(int)
-    for bucket in aggregations['unique_users']['buckets']:
-        user = bucket['key']
-        user_counts[user] += bucket['doc_count']
-    return dict(user_counts)
+def build_query_string(domain):
+    # สร้าง query โดยใช้ domain ที่รับมาเป็น parameter
+    return f"full_message:\"Access-Reject for user\" AND full_message:\"@{domain}.ac.th\" AND full_message:\"from eduroam.{domain}\" AND timestamp:[{START_TIME} TO {END_TIME}]"
 
-def main(domain):
+async def main(domains, size=1000, min_doc_count=2):
     # อ่านค่า user และ password จาก properties file
-    qw_user, qw_pass = read_properties('qw-auth.properties')
-    auth = HTTPBasicAuth(qw_user, qw_pass)
+    qw_user, qw_pass, qw_url = read_properties('qw-auth.properties')
+    auth_header = basic_auth_header(qw_user, qw_pass)
 
-    # สร้าง query โดยใช้ domain ที่รับมาเป็น parameter
-    query = {
-        "query": f"full_message:\"Access-Reject for user\" AND full_message:\"@{domain}\" AND full_message:\"from eduroam.{domain}\" AND timestamp:[2024-10-01T00:00:00Z TO 2024-10-31T23:59:59Z]",
-        "max_hits": 0,
-        "aggs": {
-            "unique_users": {
-                "terms": {
-                    "field": "full_message",
-                    "regex": f"Access-Reject for user ([^@]+@{domain}\\.ac\\.th)",
-                    "size": 65000
-                }
-            }
-        }
-    }
+    queries = [build_query(build_query_string(domain), size, min_doc_count) for domain in domains]
+
+    async with create_session(auth_header) as session:
+        try:
+            user_counts, errors = await fetch_counts(session, domains, queries, END_TIMESTAMP, qw_url)
+        except httpx.HTTPError as e:
+            print(f"An error occurred: {e}")
+            return
 
-    try:
-        quickwit_response = get_quickwit_results(query, auth)
-        results = process_results(quickwit_response['aggregations'])
+    for index, (domain, counts) in enumerate(zip(domains, user_counts)):
+        if index in errors:
+            print(f"An error occurred for {domain}: {errors[index]}")
+            continue
 
-        for user, count in results.items():
+        for user, count in counts.items():
             print(f"{user}: {count}")
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python agg-uid.py <domain>")
+    args = sys.argv[1:]
+    size = pop_int_option(args, '--size', 1000)
+    min_doc_count = pop_int_option(args, '--min-count', 2)
+
+    if len(args) != 1 or any(arg.startswith('--') for arg in args):
+        print("Usage: python agg-uid.py <domain>[,<domain>...] [--size N] [--min-count N]")
         sys.exit(1)
     
-    domain = sys.argv[1]
-    main(domain)
\ No newline at end of file
+    domains = args[0].split(',')
+    asyncio.run(main(domains, size, min_doc_count))
\ No newline at end of file
@@ -1,92 +1,52 @@
 #!/usr/bin/env python3
 
-import requests
-from requests.auth import HTTPBasicAuth
-from collections import defaultdict
+import asyncio
+import httpx
 import sys
 import datetime
-import re
-import os
-import json
 
-def read_properties(file_path):
-    properties = {}
-    with open(file_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#'):
-                key, value = line.split('=', 1)
-                properties[key.strip()] = value.strip()
-    return properties['QW_USER'], properties['QW_PASS']
+from qw_common import (
+    read_properties, basic_auth_header, create_session, build_query, fetch_counts,
+    rank_results, write_results, pop_int_option
+)
 
-def get_quickwit_results(query, auth):
-    url = "https://quickwit.a.uni.net.th/api/v1/nro-logs/search"
-    
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-    
-    response = requests.post(url, json=query, auth=auth, headers=headers)
-    response.raise_for_status()
-    return response.json()
-
-def process_results(aggregations, domain):
-    user_counts = defaultdict(int)
-    pattern = re.compile(f"Access-Reject for user ([^@]+@{domain}\\.ac\\.th)")
-    
-    for bucket in aggregations['unique_users']['buckets']:
-        match = pattern.search(bucket['key'])
-        if match:
-            user = match.group(1)
-            user_counts[user] += bucket['doc_count']
-    
-    return dict(user_counts)
-
-def main(domain):
-    qw_user, qw_pass = read_properties('qw-auth.properties')
-    auth = HTTPBasicAuth(qw_user, qw_pass)
+START_TIME = "2024-10-01T00:00:00Z"
+END_TIME = "2024-10-31T23:59:59Z"
+END_TIMESTAMP = datetime.datetime.strptime(END_TIME, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc).timestamp()
 
-    query = {
-        "query": f"full_message:\"Access-Reject for user\" AND full_message:\"@{domain}\" AND full_message:\"from eduroam.{domain}\" AND timestamp:[2024-10-01T00:00:00Z TO 2024-10-31T23:59:59Z]",
-        "max_hits": 0,
-        "aggs": {
-            "unique_users": {
-                "terms": {
-                    "field": "full_message",
-                    "size": 65000
-                }
-            }
-        }
-    }
+def build_query_string(domain):
+    return f"full_message:\"Access-Reject for user\" AND full_message:\"@{domain}.ac.th\" AND full_message:\"from eduroam.{domain}\" AND timestamp:[{START_TIME} TO {END_TIME}]"
 
-    try:
-        quickwit_response = get_quickwit_results(query, auth)
-        results = process_results(quickwit_response['aggregations'], domain)
+async def main(domains, top=None, size=1000, min_doc_count=2):
+    qw_user, qw_pass, qw_url = read_properties('qw-auth.properties')
+    auth_header = basic_auth_header(qw_user, qw_pass)
 
-        # สร้างไดเรกทอรีถ้ายังไม่มี
-        if not os.path.exists(domain):
-            os.makedirs(domain)
+    queries = [build_query(build_query_string(domain), size, min_doc_count) for domain in domains]
 
-        current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-        filename = f"{domain}/{current_time}.json"
+    async with create_session(auth_header) as session:
+        try:
+            user_counts, errors = await fetch_counts(session, domains, queries, END_TIMESTAMP, qw_url)
+        except httpx.HTTPError as e:
+            print(f"An error occurred: {e}")
+            return
 
-        # เรียงลำดับผลลัพธ์และแปลงเป็น list of dictionaries
-        sorted_results = [{"user": user, "count": count} for user, count in sorted(results.items(), key=lambda x: x[1], reverse=True)]
+    for index, (domain, counts) in enumerate(zip(domains, user_counts)):
+        if index in errors:
+            print(f"An error occurred for {domain}: {errors[index]}")
+            continue
 
-        # บันทึกผลลัพธ์เป็น JSON
-        with open(filename, 'w') as f:
-            json.dump(sorted_results, f, indent=2)
-        
-        print(f"Results have been saved to {filename}")
-
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
+        # เรียงลำดับผลลัพธ์แล้วบันทึกเป็น JSON แบบ gzip
+        write_results(domain, rank_results(counts, top))
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python agg-uid.py <domain>")
+    args = sys.argv[1:]
+    top = pop_int_option(args, '--top')
+    size = pop_int_option(args, '--size', 1000)
+    min_doc_count = pop_int_option(args, '--min-count', 2)
+
+    if len(args) != 1 or any(arg.startswith('--') for arg in args):
+        print("Usage: python agg-uid.py <domain>[,<domain>...] [--top K] [--size N] [--min-count N]")
         sys.exit(1)
     
-    domain = sys.argv[1]
-    main(domain)
\ No newline at end of file
+    domains = args[0].split(',')
+    asyncio.run(main(domains, top, size, min_doc_count))
\ No newline at end of file
@@ -1,108 +1,133 @@
 #!/usr/bin/env python3
 
-import requests
-from requests.auth import HTTPBasicAuth
-from collections import defaultdict
+import asyncio
+import httpx
 import sys
 import datetime
-import re
-import os
-import json
 import time
 
-def read_properties(file_path):
-    properties = {}
-    with open(file_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#'):
-                key, value = line.split('=', 1)
-                properties[key.strip()] = value.strip()
-    return properties['QW_USER'], properties['QW_PASS'], properties['QW_URL'].lstrip('=')
-
-
-def get_quickwit_results(query, auth, url):
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-    
-    response = requests.post(f"{url}/api/v1/nro-logs/search", json=query, auth=auth, headers=headers)
-    response.raise_for_status()
-    return response.json()
-
-def process_results(aggregations, domain):
-    user_counts = defaultdict(int)
-    pattern = re.compile(f"Access-Reject for user ([^@]+@{domain}\\.ac\\.th)")
-    
-    for bucket in aggregations['unique_users']['buckets']:
-        match = pattern.search(bucket['key'])
-        if match:
-            user = match.group(1)
-            user_counts[user] += bucket['doc_count']
-    
-    return dict(user_counts)
+from qw_common import (
+    read_properties, basic_auth_header, create_session, build_query, fetch_counts,
+    rank_results, write_results, pop_int_option
+)
 
 def get_timestamp_range(days):
     end_timestamp = int(time.time())
     start_timestamp = end_timestamp - (days * 24 * 60 * 60)
     return start_timestamp, end_timestamp
 
+SLICE_SECONDS = 7 * 24 * 60 * 60
+SLICE_BUCKET_SIZE = 65000
+
+def slice_range(start_timestamp, end_timestamp, step):
+    # ตัดช่วงเวลาตามขอบ step ที่นับจาก epoch ช่วงเต็มที่ผ่านไปแล้วจึงได้ key เดิมทุกครั้งที่รัน และใช้ cache ได้
+    boundary = (start_timestamp // step + 1) * step
+    while boundary < end_timestamp:
+        yield start_timestamp, boundary
+        start_timestamp = boundary
+        boundary += step
+    yield start_timestamp, end_timestamp
+
 def timestamp_to_human_readable(timestamp):
     return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
 
-def main(domain, days):
+def timestamp_to_rfc3339(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def build_query_string(domain, start_timestamp, end_timestamp):
+    # _elastic API ไม่มี start_timestamp/end_timestamp จึงใส่ช่วงเวลาไว้ใน query string แทน
+    # ขอบบนเป็น exclusive เหมือน end_timestamp ของ search API เพื่อไม่ให้ช่วงที่ต่อกันนับซ้ำ
+    time_range = f"timestamp:[{timestamp_to_rfc3339(start_timestamp)} TO {timestamp_to_rfc3339(end_timestamp)}}}"
+    return f"full_message:\"Access-Reject for user\" AND full_message:\"@{domain}.ac.th\" AND full_message:\"from eduroam.{domain}\" AND {time_range}"
+
+async def fetch_slice(session, semaphore, domains, queries, start_timestamp, end_timestamp, url, user_counts):
+    # slice แรกเริ่มที่ now - days ซึ่งเปลี่ยนทุกครั้งที่รัน key จึงไม่มีวันซ้ำ cache เฉพาะ slice ที่เริ่มตรงขอบ SLICE_SECONDS
+    cacheable = start_timestamp % SLICE_SECONDS == 0
+    async with semaphore:
+        slice_counts, errors = await fetch_counts(session, domains, queries, end_timestamp, url, cacheable)
+
+    for index, counts in enumerate(slice_counts):
+        if index in errors:
+            continue
+        totals = user_counts[index]
+        # slice แรกที่เสร็จใช้ dict ของ slice นั้นเป็นยอดรวมได้เลย ไม่ต้องใส่ทีละ user ให้ dict ขยายตัวซ้ำๆ
+        if not totals:
+            user_counts[index] = counts
+            continue
+        # slice ต่างกันมี user ซ้ำกันได้ จึงต้องบวกรวม
+        for user, count in counts.items():
+            totals[user] = totals.get(user, 0) + count
+    return errors
+
+def save_results(domain, results, start_timestamp, end_timestamp, top=None):
+    write_results(domain, {
+        "start_timestamp": start_timestamp,
+        "end_timestamp": end_timestamp,
+        "start_time": timestamp_to_human_readable(start_timestamp),
+        "end_time": timestamp_to_human_readable(end_timestamp),
+        "results": rank_results(results, top)
+    })
+
+async def main(domains, days, top=None, size=1000, min_doc_count=2):
     qw_user, qw_pass, qw_url = read_properties('qw-auth.properties')
-    auth = HTTPBasicAuth(qw_user, qw_pass)
+    auth_header = basic_auth_header(qw_user, qw_pass)
 
     start_timestamp, end_timestamp = get_timestamp_range(days)
-
-    query = {
-        "query": f"full_message:\"Access-Reject for user\" AND full_message:\"@{domain}\" AND full_message:\"from eduroam.{domain}\"",
-        "start_timestamp": start_timestamp,
-        "end_timestamp": end_timestamp,
-        "max_hits": 0,
-        "aggs": {
-            "unique_users": {
-                "terms": {
-                    "field": "full_message",
-                    "size": 65000
-                }
-            }
-        }
-    }
-
-    try:
-        quickwit_response = get_quickwit_results(query, auth, qw_url)
-        results = process_results(quickwit_response['aggregations'], domain)
-
-        if not os.path.exists(domain):
-            os.makedirs(domain)
-
-        current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-        filename = f"{domain}/{current_time}.json"
-
-        sorted_results = [{"user": user, "count": count} for user, count in sorted(results.items(), key=lambda x: x[1], reverse=True)]
-
-        with open(filename, 'w') as f:
-            json.dump({
-                "start_timestamp": start_timestamp,
-                "end_timestamp": end_timestamp,
-                "start_time": timestamp_to_human_readable(start_timestamp),
-                "end_time": timestamp_to_human_readable(end_timestamp),
-                "results": sorted_results
-            }, f, indent=2)
-        
-        print(f"Results have been saved to {filename}")
-
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
+    # ช่วงเวลายาวๆ แบ่งเป็น slice ละหนึ่งสัปดาห์ แต่ละ slice เป็น _msearch ของทุก domain
+    slices = list(slice_range(start_timestamp, end_timestamp, SLICE_SECONDS))
+
+    if len(slices) == 1:
+        slice_size, slice_min_doc_count = size, min_doc_count
+    else:
+        # size และ min_doc_count ต่อ slice จะตัด user ที่ไม่ติดอันดับใน slice นั้นทิ้งไปทั้ง count ทำให้ยอดรวมขาด
+        # ถ้ามีหลาย slice จึงขอ bucket ต่อ slice ให้มากพอ แล้วค่อยกรองและจำกัด size จากยอดรวมแทน
+        slice_size = max(SLICE_BUCKET_SIZE, size * len(slices))
+        slice_min_doc_count = 1
+    slice_queries = [
+        [build_query(build_query_string(domain, start, end), slice_size, slice_min_doc_count) for domain in domains]
+        for start, end in slices
+    ]
+
+    user_counts = [{} for _ in domains]
+
+    semaphore = asyncio.Semaphore(4)
+    async with create_session(auth_header) as session:
+        slice_errors = await asyncio.gather(
+            *[fetch_slice(session, semaphore, domains, queries, start, end, qw_url, user_counts)
+              for queries, (start, end) in zip(slice_queries, slices)],
+            return_exceptions=True
+        )
+
+    errors = {}
+    for result in slice_errors:
+        if isinstance(result, httpx.HTTPError):
+            print(f"An error occurred: {result}")
+            return
+        if isinstance(result, BaseException):
+            raise result
+        errors.update(result)
+
+    # --size คือจำนวน user สูงสุดในผลลัพธ์ ไม่ว่าช่วงเวลาจะถูกแบ่งเป็นกี่ slice
+    limit = size if top is None else min(top, size)
+
+    for index, (domain, counts) in enumerate(zip(domains, user_counts)):
+        if index in errors:
+            print(f"An error occurred for {domain}: {errors[index]}")
+            continue
+
+        results = {user: count for user, count in counts.items() if count >= min_doc_count}
+        save_results(domain, results, start_timestamp, end_timestamp, limit)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2 or len(sys.argv) > 3:
-        print("Usage: python agg-uid.py <domain> [days]")
+    args = sys.argv[1:]
+    top = pop_int_option(args, '--top')
+    size = pop_int_option(args, '--size', 1000)
+    min_doc_count = pop_int_option(args, '--min-count', 2)
+
+    if len(args) < 1 or len(args) > 2 or any(arg.startswith('--') for arg in args):
+        print("Usage: python agg-uid.py <domain>[,<domain>...] [days] [--top K] [--size N] [--min-count N]")
         sys.exit(1)
     
-    domain = sys.argv[1]
-    days = int(sys.argv[2]) if len(sys.argv) == 3 else 1
-    main(domain, days)
\ No newline at end of file
+    domains = args[0].split(',')
+    days = int(args[1]) if len(args) == 2 else 1
+    asyncio.run(main(domains, days, top, size, min_doc_count))
\ No newline at end of file
@@ -0,0 +1,53 @@
+# ส่วนที่ทำงานต่อ bucket ทุกตัวของ response แยกไว้ให้ compile ด้วย mypyc ได้: make (ดู README.md)
+# ถ้ายังไม่ได้ compile จะใช้ไฟล์ .py นี้ตรงๆ ผลลัพธ์เหมือนกัน
+# ถ้ามี qw_buckets*.so อยู่ python จะ import .so แทนไฟล์นี้ แก้ไฟล์นี้แล้วต้อง make ใหม่
+
+from typing import Any, Dict, Generator, List, Tuple
+
+Bucket = Dict[str, Any]
+Consumer = Generator[None, Bucket, None]
+
+BUCKET_PREFIX = "responses.item.aggregations.unique_users.buckets.item"
+BUCKET_KEY_PREFIX = BUCKET_PREFIX + ".key"
+BUCKET_COUNT_PREFIX = BUCKET_PREFIX + ".doc_count"
+
+def process_results(domain: str, user_counts: Dict[str, int]) -> Consumer:
+    # generator consumer: รับ bucket ทีละตัวผ่าน send() แล้วเขียนลง user_counts ทันที
+    # key ของ bucket คือ username ที่แยกไว้ตั้งแต่ตอน index แล้ว ไม่ต้องใช้ regex ฝั่ง client
+    # และ key ใน response เดียวกันไม่ซ้ำกัน จึงเขียนลงไปตรงๆ ได้ไม่ต้องบวกรวม
+    suffix = f"@{domain}.ac.th"
+
+    while True:
+        bucket = yield
+        user: str = bucket['key']
+        if user.endswith(suffix):
+            user_counts[user] = bucket['doc_count']
+
+class MsearchDemux:
+    # แยก event ของ ijson จาก response ของ _msearch แล้วส่ง bucket ให้ consumer ของ query นั้น
+    # เก็บ state ไว้ใน object เพราะ event ของ bucket เดียวอาจมาคนละ chunk กัน
+
+    def __init__(self, consumers: List[Consumer]) -> None:
+        self.consumers = consumers
+        self.errors: Dict[int, str] = {}
+        self.index = -1
+        self.bucket: Bucket = {}
+
+    def feed(self, events: List[Tuple[str, str, Any]]) -> None:
+        for prefix, event, value in events:
+            if prefix == BUCKET_PREFIX:
+                if event == 'start_map':
+                    self.bucket = {}
+                elif event == 'end_map':
+                    self.consumers[self.index].send(self.bucket)
+            elif prefix == BUCKET_KEY_PREFIX:
+                self.bucket['key'] = value
+            elif prefix == BUCKET_COUNT_PREFIX:
+                self.bucket['doc_count'] = value
+            elif prefix == "responses.item":
+                if event == 'start_map':
+                    self.index += 1
+                elif event == 'map_key' and value == 'error':
+                    self.errors[self.index] = "unknown error"
+            elif prefix in ("responses.item.error", "responses.item.error.reason") and event == 'string':
+                self.errors[self.index] = value
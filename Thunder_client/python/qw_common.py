@@ -0,0 +1,193 @@
+# ส่วนที่ใช้ร่วมกันของ agg-uid.py, agg-uid-static-month.py และ agg-uid-console.py
+
+import asyncio
+import base64
+import httpx
+import ijson
+import mmap
+import os
+import orjson
+import gzip
+import time
+import hashlib
+import heapq
+import operator
+
+from qw_buckets import MsearchDemux, process_results
+
+DEFAULT_QW_URL = "https://quickwit.a.uni.net.th"
+
+_props_cache = {"path": None, "mtime": 0, "value": None}
+
+def read_properties(file_path):
+    # อ่านไฟล์ใหม่เฉพาะเมื่อ mtime เปลี่ยน เช่นตอนเปลี่ยน password ระหว่างที่ process ยังทำงานอยู่
+    mtime = os.stat(file_path).st_mtime_ns
+    if _props_cache["path"] == file_path and _props_cache["mtime"] == mtime:
+        return _props_cache["value"]
+
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        lines = (line.strip() for line in mm[:].decode().splitlines())
+        pairs = (line.split('=', 1) for line in lines if line and not line.startswith('#'))
+        properties = {key.strip(): value.strip() for key, value in pairs}
+    value = properties['QW_USER'], properties['QW_PASS'], properties.get('QW_URL', DEFAULT_QW_URL).lstrip('=')
+
+    _props_cache.update(path=file_path, mtime=mtime, value=value)
+    return value
+
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.2
+RETRY_STATUS = (502, 503, 504)
+
+def basic_auth_header(user, password):
+    # สร้าง header "Authorization: Basic ..." ครั้งเดียว ไม่ต้องให้ auth flow ของ httpx สร้างใหม่ทุก request
+    return "Basic " + base64.b64encode(f"{user}:{password}".encode()).decode()
+
+def create_session(auth_header):
+    # client เดียวที่ keep-alive ไว้ตลอดการทำงาน ผ่าน HTTP/2 ทุก query ที่ยิงพร้อมกันใช้ connection เดียวกันได้
+    limits = httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60)
+    headers = {"Authorization": auth_header}
+    return httpx.AsyncClient(http2=True, headers=headers, timeout=30.0, limits=limits)
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+async def get_quickwit_msearch(session, queries, url, consumers):
+    headers = {
+        "Content-Type": "application/x-ndjson",
+        "Accept": "application/json"
+    }
+
+    # NDJSON ของ _msearch: แต่ละ query มี header บรรทัดหนึ่ง ตามด้วย body อีกบรรทัด
+    interleaved = [line for query in queries for line in ({"index": "nro-logs"}, query)]
+    payload = b"\n".join(orjson.dumps(x) for x in interleaved) + b"\n"
+
+    for attempt in range(RETRY_TOTAL + 1):
+        if attempt:
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        # retry ได้เฉพาะก่อนเริ่มอ่าน body เท่านั้น เพราะ bucket ถูกส่งให้ consumer ระหว่าง stream ไปแล้ว
+        try:
+            async with session.stream("POST", f"{url}/api/v1/_elastic/nro-logs/_msearch", content=payload, headers=headers) as response:
+                if response.status_code in RETRY_STATUS and attempt < RETRY_TOTAL:
+                    continue
+                response.raise_for_status()
+                return await stream_msearch_buckets(response.aiter_bytes(STREAM_CHUNK_SIZE), consumers)
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            if attempt == RETRY_TOTAL:
+                raise
+
+async def stream_msearch_buckets(chunks, consumers):
+    # parse response ของ _msearch แบบ streaming ทีละ chunk แล้วส่ง bucket ให้ consumer ของ query นั้นทันทีที่อ่านได้
+    demux = MsearchDemux(consumers)
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events)
+    async for chunk in chunks:
+        parser.send(chunk)
+        demux.feed(events)
+        del events[:]
+    parser.close()
+    demux.feed(events)
+    return demux.errors
+
+CACHE_DIR = ".qw_cache"
+CACHE_MIN_AGE = 24 * 60 * 60
+
+def cache_path(query):
+    # key มาจาก query ทั้งก้อน (domain, ช่วงเวลา, aggregation) ผลที่ cache ไว้จึงตรงกับ query นั้นเสมอ
+    key = hashlib.blake2b(orjson.dumps(query, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+def is_cacheable(end_timestamp):
+    # log ภายใน 24 ชั่วโมงล่าสุดยังเพิ่มได้อยู่ จึงไม่ cache
+    return end_timestamp <= time.time() - CACHE_MIN_AGE
+
+def read_cache(query, end_timestamp):
+    if not is_cacheable(end_timestamp):
+        return None
+    try:
+        with open(cache_path(query), 'rb') as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+def write_cache(query, end_timestamp, results):
+    if not is_cacheable(end_timestamp):
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = cache_path(query)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(orjson.dumps(results))
+    os.replace(tmp, path)
+
+def build_query(query_string, size, min_doc_count):
+    return {
+        "query": {
+            "query_string": {
+                "query": query_string
+            }
+        },
+        "size": 0,
+        "aggs": {
+            "unique_users": {
+                "terms": {
+                    "field": "username",
+                    "size": size,
+                    "shard_size": size * 2,
+                    "min_doc_count": min_doc_count
+                }
+            }
+        }
+    }
+
+async def fetch_counts(session, domains, queries, end_timestamp, url, cacheable=True):
+    # user count ของ domain ที่มีใน cache อ่านจาก cache ที่เหลือรวมไว้ใน _msearch request เดียว
+    # cacheable=False สำหรับ query ที่จะไม่ถูกถามซ้ำอีก ไม่ต้องอ่านหรือเขียน cache
+    user_counts = [read_cache(query, end_timestamp) if cacheable else None for query in queries]
+    pending = [index for index, counts in enumerate(user_counts) if counts is None]
+
+    errors = {}
+    if pending:
+        consumers = []
+        for index in pending:
+            user_counts[index] = {}
+            consumer = process_results(domains[index], user_counts[index])
+            next(consumer)
+            consumers.append(consumer)
+
+        pending_errors = await get_quickwit_msearch(session, [queries[index] for index in pending], url, consumers)
+        errors = {pending[position]: error for position, error in pending_errors.items()}
+
+        for index in pending:
+            if cacheable and index not in errors:
+                write_cache(queries[index], end_timestamp, user_counts[index])
+
+    return user_counts, errors
+
+def rank_results(results, top=None):
+    if top is None:
+        ranked = sorted(results.items(), key=operator.itemgetter(1), reverse=True)
+    else:
+        # ต้องการแค่ K อันดับแรก ไม่ต้อง sort ทั้งหมด
+        ranked = heapq.nlargest(top, results.items(), key=operator.itemgetter(1))
+    return [{"user": user, "count": count} for user, count in ranked]
+
+def write_results(domain, payload):
+    # ไฟล์ผลลัพธ์อยู่ใต้ไดเรกทอรีชื่อ domain ต่อท้ายชื่อด้วย pid กันชื่อไฟล์ชนกันเมื่อหลาย process จบในวินาทีเดียวกัน
+    os.makedirs(domain, exist_ok=True)
+    filename = f"{domain}/{int(time.time())}-{os.getpid()}.json"
+
+    # เขียนแบบ gzip ลงไฟล์ชั่วคราวก่อนแล้วค่อย rename ถ้าถูกขัดจังหวะกลางทางจะไม่เหลือไฟล์ผลลัพธ์ที่เขียนไม่ครบ
+    tmp = f"{filename}.tmp.gz"
+    with gzip.open(tmp, 'wb', compresslevel=1) as f:
+        f.write(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, f"{filename}.gz")
+
+    print(f"Results have been saved to {filename}.gz")
+
+def pop_int_option(args, name, default=None):
+    # ดึง option รูปแบบ "--name N" ออกจาก args ถ้าไม่มีคืนค่า default
+    if name in args and args.index(name) + 1 < len(args):
+        position = args.index(name)
+        value = int(args[position + 1])
+        del args[position:position + 2]
+        return value
+    return default